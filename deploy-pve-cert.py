@@ -5,134 +5,180 @@ Deploy SSL certificates from Nginx Proxy Manager to Proxmox VE
 
 import os
 import sys
+import grp
+import hashlib
+import shlex
 import subprocess
 import shutil
-import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
+from pve_cert_common import load_config, run_cmd, make_logger, make_parser
 
-def load_config(config_file):
-    """Load configuration from file"""
-    config = {}
-    with open(config_file, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('#') or not line or '=' not in line:
-                continue
-            key, value = line.split('=', 1)
-            config[key.strip()] = value.strip()
-    return config
 
+def ssh_options(config, control_path):
+    """Build SSH options sharing one multiplexed connection"""
+    return [
+        '-o', f'ControlPath={control_path}', '-o', 'ControlMaster=auto',
+        '-o', 'ControlPersist=60s', '-o', 'BatchMode=yes',
+        '-i', config['SYNOLOGY_SSH_KEY'],
+    ]
 
-def run_cmd(cmd, check=True):
-    """Run command and return result"""
-    result = subprocess.run(cmd, check=check, capture_output=True, text=True)
-    return result
 
-
-def log_message(msg, log_file):
-    """Write log message"""
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    log_msg = f"[{timestamp}] {msg}"
-    print(log_msg)
-
-    Path(log_file).parent.mkdir(parents=True, exist_ok=True)
-    with open(log_file, 'a') as f:
-        f.write(log_msg + '\n')
-
-
-def check_ssh_connection(config):
-    """Verify SSH connection to Synology"""
-    ssh_key = config['SYNOLOGY_SSH_KEY']
+def check_ssh_connection(config, ssh_opts):
+    """Verify SSH connection to Synology and open the master connection"""
     synology_user = config['SYNOLOGY_USER']
     synology_host = config['SYNOLOGY_HOST']
 
     try:
         run_cmd([
-            'ssh', '-i', ssh_key, '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=10',
-            f"{synology_user}@{synology_host}", 'echo test'
+            'ssh', *ssh_opts, '-o', 'ConnectTimeout=10', '-M', '-N', '-f',
+            f"{synology_user}@{synology_host}"
         ])
         return True
     except subprocess.CalledProcessError:
         return False
 
 
-def backup_certs(config, log_file):
-    """Backup existing certificates"""
-    backup_dir = Path(config['BACKUP_DIR'])
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_path = backup_dir / timestamp
-    backup_path.mkdir(parents=True, exist_ok=True)
-
-    cert = Path(config['PVE_CERT_PATH'])
-    key = Path(config['PVE_KEY_PATH'])
-
-    if cert.exists() and key.exists():
-        # Read and write directly for /etc/pve FUSE filesystem
-        with open(cert, 'rb') as src:
-            with open(backup_path / 'pveproxy-ssl.pem', 'wb') as dst:
-                dst.write(src.read())
-        with open(key, 'rb') as src:
-            with open(backup_path / 'pveproxy-ssl.key', 'wb') as dst:
-                dst.write(src.read())
-        log_message(f"Backed up to {backup_path}", log_file)
-
-
-def download_certs(config, log_file):
-    """Download certificates from Synology"""
-    ssh_key = config['SYNOLOGY_SSH_KEY']
+def close_ssh_connection(config, ssh_opts):
+    """Tear down the master connection"""
+    synology_user = config['SYNOLOGY_USER']
+    synology_host = config['SYNOLOGY_HOST']
+
+    run_cmd(['ssh', *ssh_opts, '-O', 'exit', f"{synology_user}@{synology_host}"],
+            check=False)
+
+
+def _state_file(config):
+    """Path of the file recording the last successfully deployed hashes"""
+    return os.path.join(config['BACKUP_DIR'], 'deployed.sha256')
+
+
+def certs_unchanged(config, ssh_opts):
+    """Check whether the NPM certificates match the last successful deployment"""
     synology = f"{config['SYNOLOGY_USER']}@{config['SYNOLOGY_HOST']}"
     npm_path = config['NPM_CERT_PATH']
 
-    import tempfile
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmp_path = Path(tmpdir)
+    # Compare against what pveproxy last loaded, not the files on disk, so a
+    # run that installed the files but failed to reload is retried
+    try:
+        with open(_state_file(config)) as f:
+            deployed_hashes = f.read().split()
+    except FileNotFoundError:
+        return False
+
+    remote = [shlex.quote(f"{npm_path}/{name}") for name in ('fullchain.pem', 'privkey.pem')]
+    result = run_cmd(['ssh', *ssh_opts, synology, 'sha256sum', *remote], check=False)
+    if result.returncode != 0:
+        return False
+
+    remote_hashes = [line.split()[0] for line in result.stdout.splitlines() if line]
+    return remote_hashes == deployed_hashes
 
-        # Download cert files (use -O for legacy SCP protocol)
-        run_cmd(['scp', '-O', '-i', ssh_key, '-o', 'BatchMode=yes',
-                f"{synology}:{npm_path}/fullchain.pem", str(tmp_path / 'fullchain.pem')])
-        run_cmd(['scp', '-O', '-i', ssh_key, '-o', 'BatchMode=yes',
-                f"{synology}:{npm_path}/privkey.pem", str(tmp_path / 'privkey.pem')])
 
-        # Copy to Proxmox paths (read and write directly for /etc/pve FUSE filesystem)
-        with open(tmp_path / 'fullchain.pem', 'rb') as src:
-            with open(config['PVE_CERT_PATH'], 'wb') as dst:
-                dst.write(src.read())
-        with open(tmp_path / 'privkey.pem', 'rb') as src:
-            with open(config['PVE_KEY_PATH'], 'wb') as dst:
-                dst.write(src.read())
+def save_deployed_hashes(config, hashes):
+    """Record the hashes of the certificates pveproxy has loaded"""
+    os.makedirs(config['BACKUP_DIR'], exist_ok=True)
+    with open(_state_file(config), 'w') as f:
+        f.write('\n'.join(hashes) + '\n')
 
-    log_message("Certificates downloaded", log_file)
 
+def backup_certs(config, log):
+    """Backup existing certificates"""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    backup_path = os.path.join(config['BACKUP_DIR'], timestamp)
+    os.makedirs(backup_path, exist_ok=True)
 
-def set_permissions(config, log_file):
-    """Set certificate permissions"""
     cert = config['PVE_CERT_PATH']
     key = config['PVE_KEY_PATH']
 
-    run_cmd(['chown', 'root:www-data', cert, key])
-    run_cmd(['chmod', '640', cert, key])
+    if os.path.exists(cert) and os.path.exists(key):
+        # Backups live on a regular filesystem, so copyfile can use sendfile
+        shutil.copyfile(cert, os.path.join(backup_path, 'pveproxy-ssl.pem'))
+        shutil.copyfile(key, os.path.join(backup_path, 'pveproxy-ssl.key'))
+        log(f"Backed up to {backup_path}")
 
-    log_message("Permissions set", log_file)
 
+def download_certs(config, ssh_opts, tmp_path, log):
+    """Download certificates from Synology into a temporary directory"""
+    synology = f"{config['SYNOLOGY_USER']}@{config['SYNOLOGY_HOST']}"
+    npm_path = config['NPM_CERT_PATH']
 
-def restart_pveproxy(log_file):
-    """Restart pveproxy service"""
-    run_cmd(['systemctl', 'restart', 'pveproxy'])
-    result = run_cmd(['systemctl', 'is-active', 'pveproxy'], check=False)
+    # Download both cert files in one session (use -O for legacy SCP protocol).
+    # scp rides the already authenticated master connection, so this costs
+    # no extra handshake; an in-process SSH client could not share it.
+    run_cmd(['scp', '-O', *ssh_opts,
+            f"{synology}:{npm_path}/fullchain.pem",
+            f"{synology}:{npm_path}/privkey.pem", str(tmp_path)])
+
+    log("Certificates downloaded")
+
+
+def install_certs(config, tmp_path, log):
+    """Install downloaded certificates to Proxmox paths"""
+    cert_bytes = (tmp_path / 'fullchain.pem').read_bytes()
+    key_bytes = (tmp_path / 'privkey.pem').read_bytes()
+
+    # Write both files to siblings with their final owner and mode before
+    # renaming either, so a failure while preparing the key cannot leave a
+    # new cert paired with the old key. Calls on the /etc/pve FUSE
+    # filesystem are expensive, so keep them to a minimum.
+    gid = grp.getgrnam('www-data').gr_gid
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC
+    pending = []
+    try:
+        for path, data in ((config['PVE_CERT_PATH'], cert_bytes),
+                           (config['PVE_KEY_PATH'], key_bytes)):
+            tmp = f"{path}.new"
+            pending.append((tmp, path))
+            fd = os.open(tmp, flags, 0o640)
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                os.fchown(fd, 0, gid)
+                os.fchmod(fd, 0o640)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        # Both files are complete; swap them in back to back
+        for tmp, path in pending:
+            os.replace(tmp, path)
+    except BaseException:
+        # Never leave a partial PEM behind in the replicated /etc/pve
+        for tmp, _ in pending:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+        raise
+
+    log("Certificates installed")
+
+
+def restart_pveproxy(log):
+    """Reload pveproxy service, restarting it if the reload fails"""
+    # A graceful reload picks up the new certificate without dropping
+    # live connections; fall back to a full restart if that fails
+    action = 'reloaded'
+    result = run_cmd(['systemctl', 'reload', 'pveproxy'], check=False, capture=False)
+    if result.returncode != 0:
+        run_cmd(['systemctl', 'restart', 'pveproxy'], capture=False)
+        action = 'restarted'
+
+    result = run_cmd(['systemctl', 'is-active', 'pveproxy'], check=False, capture=False)
 
     if result.returncode == 0:
-        log_message("pveproxy restarted", log_file)
+        log(f"pveproxy {action}")
         return True
     return False
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Deploy SSL certs from NPM to Proxmox')
-    parser.add_argument('--config', '-c', default='/root/deploy-certs/deploy-pve-cert.conf',
-                       help='Config file path')
-    args = parser.parse_args()
+    args = make_parser('Deploy SSL certs from NPM to Proxmox').parse_args()
 
     if not os.path.exists(args.config):
         print(f"Error: Config file not found: {args.config}")
@@ -145,29 +191,52 @@ def main():
     try:
         config = load_config(args.config)
         log_file = config['LOG_FILE']
-
-        log_message("Starting certificate deployment", log_file)
-
-        # Verify SSH
-        if not check_ssh_connection(config):
-            log_message("Error: SSH connection failed", log_file)
-            sys.exit(1)
-
-        # Backup existing certs
-        backup_certs(config, log_file)
-
-        # Download new certs
-        download_certs(config, log_file)
-
-        # Set permissions
-        set_permissions(config, log_file)
+        os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+        log = make_logger(log_file)
+
+        log("Starting certificate deployment")
+
+        # Private work dir for the SSH control socket and downloaded certs;
+        # one SSH connection is shared between the check and the download
+        work_dir = Path(tempfile.mkdtemp(prefix='pve-cert-'))
+        ssh_opts = ssh_options(config, work_dir / 'ssh.sock')
+
+        try:
+            # Verify SSH
+            if not check_ssh_connection(config, ssh_opts):
+                log("Error: SSH connection failed")
+                sys.exit(1)
+
+            # Skip deployment and the pveproxy restart if nothing changed
+            if certs_unchanged(config, ssh_opts):
+                log("Certificate unchanged - nothing to deploy")
+                return
+
+            # Backup existing certs while downloading new ones
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                backup = executor.submit(backup_certs, config, log)
+                download = executor.submit(download_certs, config, ssh_opts,
+                                           work_dir, log)
+                backup.result()
+                download.result()
+
+            # Install new certs only once the backup has completed
+            install_certs(config, work_dir, log)
+            hashes = [hashlib.sha256((work_dir / name).read_bytes()).hexdigest()
+                      for name in ('fullchain.pem', 'privkey.pem')]
+        finally:
+            close_ssh_connection(config, ssh_opts)
+            shutil.rmtree(work_dir, ignore_errors=True)
 
         # Restart service
-        if not restart_pveproxy(log_file):
-            log_message("Error: pveproxy failed to start", log_file)
+        if not restart_pveproxy(log):
+            log("Error: pveproxy failed to start")
             sys.exit(1)
 
-        log_message(f"Deployment complete - https://{config['DOMAIN']}:8006", log_file)
+        # Record the hashes only once pveproxy has loaded the new certs
+        save_deployed_hashes(config, hashes)
+
+        log(f"Deployment complete - https://{config['DOMAIN']}:8006")
 
     except Exception as e:
         print(f"Error: {str(e)}")
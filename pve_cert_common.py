@@ -0,0 +1,86 @@
+"""
+Shared helpers for the Proxmox VE certificate scripts
+"""
+
+import os
+import signal
+import subprocess
+import threading
+import argparse
+import re
+import functools
+import types
+from pathlib import Path
+from datetime import datetime
+
+DEFAULT_CONFIG = '/root/deploy-certs/deploy-pve-cert.conf'
+
+# KEY=VALUE lines; comments, blank lines and lines without '=' never match
+_CONFIG_RE = re.compile(r'^[ \t]*([^#=\s][^=\n]*?)[ \t]*=[ \t]*(.*?)\s*$', re.M)
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_config(config_file, mtime, size):
+    """Parse configuration file (cached on path, mtime and size)"""
+    text = Path(config_file).read_text()
+    return types.MappingProxyType(dict(_CONFIG_RE.findall(text)))
+
+
+def load_config(config_file):
+    """Load configuration from file"""
+    st = os.stat(config_file)
+    return _parse_config(config_file, st.st_mtime_ns, st.st_size)
+
+
+def _spawn(argv):
+    """Run argv with stdout and stderr on /dev/null and return its exit code"""
+    # Restore the signals Python ignores, as subprocess does by default
+    pid = os.posix_spawnp(argv[0], argv, os.environ, file_actions=[
+        (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+        (os.POSIX_SPAWN_DUP2, 1, 2),
+    ], setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+    try:
+        _, status = os.waitpid(pid, 0)
+    except BaseException:
+        # Like subprocess.run, don't leave the child running on Ctrl-C
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        raise
+    return os.waitstatus_to_exitcode(status)
+
+
+def run_cmd(cmd, check=True, capture=True, input=None):
+    """Run command and return result"""
+    if not capture:
+        # Output is never read, so skip subprocess and its pipe setup
+        returncode = _spawn(cmd)
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return subprocess.CompletedProcess(cmd, returncode)
+    result = subprocess.run(cmd, check=check, capture_output=True, text=True,
+                            input=input)
+    return result
+
+
+def make_logger(log_file):
+    """Return a function writing log messages to stdout and log_file"""
+    f = open(log_file, 'a', buffering=1)
+    _now = datetime.now
+    # log may be called from worker threads; keep each line whole
+    lock = threading.Lock()
+
+    def log(msg):
+        log_msg = f"[{_now():%Y-%m-%d %H:%M:%S}] {msg}"
+        with lock:
+            print(log_msg)
+            f.write(log_msg + '\n')
+
+    return log
+
+
+def make_parser(description):
+    """Create argument parser with the shared --config option"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--config', '-c', default=DEFAULT_CONFIG,
+                       help='Config file path')
+    return parser
@@ -5,52 +5,80 @@ Check Proxmox VE SSL certificate status
 
 import os
 import sys
-import subprocess
-import argparse
-from pathlib import Path
-from datetime import datetime
-
-
-def load_config(config_file):
-    """Load configuration from file"""
-    config = {}
-    with open(config_file, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith('#') or not line or '=' not in line:
-                continue
-            key, value = line.split('=', 1)
-            config[key.strip()] = value.strip()
-    return config
-
-
-def run_cmd(cmd):
-    """Run command and return output"""
-    try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        return result.stdout.strip()
-    except subprocess.CalledProcessError:
-        return None
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from pve_cert_common import load_config, run_cmd, make_parser
+
+try:
+    from cryptography import x509
+except ImportError:
+    x509 = None
 
+# field=value lines printed by `openssl x509 -noout`
+_CERT_FIELD_RE = re.compile(r'^(subject|issuer|notBefore|notAfter)=[ \t]*(.*?)\s*$', re.M)
 
-def get_cert_field(cert_path, field):
-    """Get specific field from certificate"""
-    return run_cmd(['openssl', 'x509', '-in', cert_path, '-noout', field])
+
+def get_cert_fields(pem):
+    """Get subject, issuer and validity dates from PEM certificate data"""
+    result = run_cmd(['openssl', 'x509', '-noout',
+                      '-subject', '-issuer', '-startdate', '-enddate'],
+                     check=False, input=pem.decode('ascii', 'replace'))
+    if result.returncode != 0:
+        return {}
+    return dict(_CERT_FIELD_RE.findall(result.stdout))
 
 
 def parse_date(date_str):
-    """Parse OpenSSL date to datetime"""
+    """Parse OpenSSL date to UTC datetime"""
+    # OpenSSL always prints GMT; avoid the locale-dependent %Z directive
     try:
-        return datetime.strptime(date_str, "%b %d %H:%M:%S %Y %Z")
+        dt = datetime.strptime(date_str.replace(' GMT', ''), "%b %d %H:%M:%S %Y")
     except ValueError:
         return None
+    return dt.replace(tzinfo=timezone.utc)
+
+
+def _cert_date(cert, name):
+    """Get UTC validity date (cryptography < 42 lacks the *_utc properties)"""
+    value = getattr(cert, f'{name}_utc', None)
+    if value is None:
+        return getattr(cert, name).replace(tzinfo=timezone.utc)
+    return value
+
+
+def get_cert_info(pem):
+    """Get subject, issuer and validity dates from PEM certificate data"""
+    if x509 is None:
+        # Fall back to the openssl binary when cryptography is unavailable
+        fields = get_cert_fields(pem)
+        return {
+            'subject': fields.get('subject'),
+            'issuer': fields.get('issuer'),
+            'not_before': fields.get('notBefore'),
+            'not_after': fields.get('notAfter'),
+            'not_after_dt': parse_date(fields.get('notAfter', '')),
+        }
+
+    try:
+        cert = x509.load_pem_x509_certificate(pem)
+    except ValueError:
+        return {}
+
+    not_before = _cert_date(cert, 'not_valid_before')
+    not_after = _cert_date(cert, 'not_valid_after')
+    return {
+        'subject': cert.subject.rfc4514_string(),
+        'issuer': cert.issuer.rfc4514_string(),
+        'not_before': f"{not_before:%b %d %H:%M:%S %Y} GMT",
+        'not_after': f"{not_after:%b %d %H:%M:%S %Y} GMT",
+        'not_after_dt': not_after,
+    }
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Verify Proxmox VE SSL certificate')
-    parser.add_argument('--config', '-c', default='/root/deploy-certs/deploy-pve-cert.conf',
-                       help='Config file path')
-    args = parser.parse_args()
+    args = make_parser('Verify Proxmox VE SSL certificate').parse_args()
 
     if not os.path.exists(args.config):
         print(f"Config file not found: {args.config}")
@@ -59,46 +87,55 @@ def main():
     config = load_config(args.config)
     cert_path = config.get('PVE_CERT_PATH', '/etc/pve/local/pveproxy-ssl.pem')
 
-    if not os.path.exists(cert_path):
-        print(f"Certificate not found: {cert_path}")
-        sys.exit(1)
+    # Check the service in the background while the certificate is read
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        service = executor.submit(run_cmd, ['systemctl', 'is-active', 'pveproxy'],
+                                  check=False, capture=False)
+
+        # Read and stat the certificate once; everything below uses these
+        try:
+            with open(cert_path, 'rb') as f:
+                pem = f.read()
+                stat = os.fstat(f.fileno())
+        except OSError as e:
+            print(f"Certificate not readable: {cert_path} ({e.strerror})")
+            sys.exit(1)
+
+        result = service.result()
 
     print("Proxmox VE Certificate Status")
     print("=" * 60)
 
     # Service status
-    result = subprocess.run(['systemctl', 'is-active', 'pveproxy'],
-                          capture_output=True, text=True)
     service_status = "Running" if result.returncode == 0 else "Not Running"
     print(f"pveproxy: {service_status}")
     print()
 
     # Certificate info
-    subject = get_cert_field(cert_path, '-subject')
+    info = get_cert_info(pem)
+
+    subject = info.get('subject')
     if subject:
-        subject = subject.replace('subject=', '').strip()
         print(f"Subject: {subject}")
 
-    issuer = get_cert_field(cert_path, '-issuer')
+    issuer = info.get('issuer')
     if issuer:
-        issuer = issuer.replace('issuer=', '').strip()
         print(f"Issuer: {issuer}")
 
     # Validity dates
-    start_date = get_cert_field(cert_path, '-startdate')
-    end_date = get_cert_field(cert_path, '-enddate')
+    start_date = info.get('not_before')
+    end_date = info.get('not_after')
 
     if start_date:
-        print(f"Valid From: {start_date.replace('notBefore=', '')}")
+        print(f"Valid From: {start_date}")
 
     if end_date:
-        end_str = end_date.replace('notAfter=', '')
-        print(f"Valid Until: {end_str}")
+        print(f"Valid Until: {end_date}")
 
         # Calculate days remaining
-        end_dt = parse_date(end_str)
+        end_dt = info.get('not_after_dt')
         if end_dt:
-            days = (end_dt - datetime.utcnow()).days
+            days = (end_dt - datetime.now(timezone.utc)).days
             print(f"\nDays Remaining: {days}")
 
             if days < 0:
@@ -108,7 +145,6 @@ def main():
 
     # File info
     print("\n" + "=" * 60)
-    stat = os.stat(cert_path)
     mtime = datetime.fromtimestamp(stat.st_mtime)
     print(f"Certificate: {cert_path}")
     print(f"Last Modified: {mtime.strftime('%Y-%m-%d %H:%M:%S')}")